@@ -1,7 +1,9 @@
-from unittest import mock
+import re
+from operator import attrgetter
 
 import jwt
 import pytest
+from django.test.utils import override_settings
 from social_django.models import UserSocialAuth
 from social_django.storage import BaseDjangoStorage
 from social_django.strategy import DjangoStrategy
@@ -11,104 +13,123 @@ from ansible_base.resource_registry.resource_server import get_resource_server_c
 from ansible_base.resource_registry.utils.auth_code import get_user_auth_code
 from ansible_base.resource_registry.utils.service_backed_sso_pipeline import redirect_to_resource_server
 
+pytestmark = pytest.mark.django_db(databases=["default"])
 
-def _validate_auth_code(auth_code, user):
-    cfg = get_resource_server_config()
+_AUTH_CODE_RE = re.compile(r"[?&]auth_code=([^&]+)")
+
+
+def _decode_auth_codes(auth_codes, user, cfg):
+    secret_key = cfg["SECRET_KEY"]
+    algorithms = [cfg["JWT_ALGORITHM"]]
+    ansible_id = str(user.resource.ansible_id)
+
+    decoded = []
+    for auth_code in auth_codes:
+        data = jwt.decode(
+            auth_code,
+            secret_key,
+            algorithms=algorithms,
+            required=["iss", "exp"],
+        )
+
+        assert data["username"] == user.username
+        assert data["sub"] == ansible_id
+
+        decoded.append(data)
 
-    data = jwt.decode(
-        auth_code,
-        cfg["SECRET_KEY"],
-        algorithms=cfg["JWT_ALGORITHM"],
-        required=["iss", "exp"],
-    )
+    return decoded
 
-    assert data["username"] == user.username
-    assert data["sub"] == str(user.resource.ansible_id)
 
+def _validate_auth_code(auth_code, user, cfg):
+    (data,) = _decode_auth_codes([auth_code], user, cfg)
     return data
 
 
+@pytest.fixture(scope="session")
+def resource_server_config():
+    cfg = get_resource_server_config()
+    # Encode the HMAC secret once so every jwt.decode in this module gets ready-to-use key bytes
+    return {**cfg, "SECRET_KEY": cfg["SECRET_KEY"].encode()}
+
+
 @pytest.fixture
-def patched_load_strategy():
+def patched_load_strategy(monkeypatch):
     def _get_strat():
         return DjangoStrategy(storage=BaseDjangoStorage())
 
-    with mock.patch("ansible_base.resource_registry.utils.sso_provider.load_strategy", _get_strat) as get_strat:
-        yield get_strat
+    monkeypatch.setattr("ansible_base.resource_registry.utils.sso_provider.load_strategy", _get_strat)
+    return _get_strat
 
 
 @pytest.fixture
 def authenticator_user(user, github_authenticator):
-    AuthenticatorUser.objects.create(provider=github_authenticator, user=user, uid="my_uid")
+    authenticator_user = AuthenticatorUser.objects.create(provider=github_authenticator, user=user, uid="my_uid")
 
-    return user, user.authenticator_users.first()
+    return user, authenticator_user
 
 
 @pytest.fixture
 def social_user(user, patched_load_strategy):
-    UserSocialAuth.objects.create(provider="github", user=user, uid="my_uid")
-
-    return user, user.social_auth.first()
-
+    social_auth = UserSocialAuth.objects.create(provider="github", user=user, uid="my_uid")
 
-@pytest.mark.django_db
-def test_user_auth_code_generation_social_auth(social_user):
-    user, social = social_user
-    auth_code = get_user_auth_code(user)
-    data = _validate_auth_code(auth_code, user)
-    assert data["sso_uid"] is None
-    assert data["sso_backend"] is None
+    return user, social_auth
 
-    auth_code = get_user_auth_code(user, social_user=social)
-    data = _validate_auth_code(auth_code, user)
-
-    assert data["sso_uid"] == "my_uid"
-    assert data["sso_backend"] == social.provider
-    assert data["sso_server"] == "https://github.com/login/oauth/authorize"
 
-
-@pytest.mark.django_db
-def test_user_auth_code_generation_dab(authenticator_user):
-    user, social = authenticator_user
-    auth_code = get_user_auth_code(user)
-    data = _validate_auth_code(auth_code, user)
-    assert data["sso_uid"] is None
-    assert data["sso_backend"] is None
-
-    auth_code = get_user_auth_code(user, social_user=social)
-    data = _validate_auth_code(auth_code, user)
+@pytest.fixture
+def social_fixture(request):
+    return request.getfixturevalue(request.param)
+
+
+@pytest.mark.parametrize(
+    "social_fixture, expected_backend_attr",
+    [
+        ("social_user", "provider"),
+        ("authenticator_user", "provider.slug"),
+    ],
+    indirect=["social_fixture"],
+    ids=["social_auth", "dab"],
+)
+def test_user_auth_code_generation(social_fixture, expected_backend_attr, resource_server_config):
+    user, social = social_fixture
+    auth_code_none = get_user_auth_code(user)
+    auth_code_social = get_user_auth_code(user, social_user=social)
+    data_none, data = _decode_auth_codes([auth_code_none, auth_code_social], user, resource_server_config)
+
+    assert data_none["sso_uid"] is None
+    assert data_none["sso_backend"] is None
 
     assert data["sso_uid"] == "my_uid"
-    assert data["sso_backend"] == social.provider.slug
+    assert data["sso_backend"] == attrgetter(expected_backend_attr)(social)
     assert data["sso_server"] == "https://github.com/login/oauth/authorize"
 
 
-@pytest.mark.django_db
-def test_auth_code_pipeline(settings, social_user):
-    settings.ENABLE_SERVICE_BACKED_SSO = True
+@override_settings(ENABLE_SERVICE_BACKED_SSO=True)
+@pytest.mark.parametrize(
+    "social_fixture, expected_backend_attr, response",
+    [
+        ("social_user", "provider", {"sub": "my_uid", "preferred_username": "123123123123123"}),
+        ("authenticator_user", "provider.slug", {"sub": "123123123123123", "preferred_username": "my_uid"}),
+    ],
+    indirect=["social_fixture"],
+    ids=["social_auth", "dab"],
+)
+def test_auth_code_pipeline(social_fixture, expected_backend_attr, response, resource_server_config):
+    user, social = social_fixture
 
-    user, social = social_user
-
-    response = {
-        "sub": "my_uid",
-        "preferred_username": "123123123123123",
-    }
     resp = redirect_to_resource_server(user=user, social=social, response=response)
 
-    auth_code = resp.url.split("?auth_code=")[1]
+    auth_code = _AUTH_CODE_RE.search(resp.url).group(1)
 
-    data = _validate_auth_code(auth_code, user)
+    data = _validate_auth_code(auth_code, user, resource_server_config)
 
     assert data["sso_uid"] == "my_uid"
-    assert data["sso_backend"] == social.provider
+    assert data["sso_backend"] == attrgetter(expected_backend_attr)(social)
     assert data["sso_server"] == "https://github.com/login/oauth/authorize"
     assert data["oidc_alt_key"] == "123123123123123"
 
 
-@pytest.mark.django_db
-def test_auth_code_pipeline_resource_server_unset(social_user, settings):
-    settings.ENABLE_SERVICE_BACKED_SSO = False
-
+@override_settings(ENABLE_SERVICE_BACKED_SSO=False)
+def test_auth_code_pipeline_resource_server_unset(social_user):
     user, social = social_user
 
     response = {
@@ -119,45 +140,19 @@ def test_auth_code_pipeline_resource_server_unset(social_user, settings):
     assert resp is None
 
 
-@pytest.mark.django_db
-def test_auth_code_pipeline_dab(authenticator_user, settings):
-    settings.ENABLE_SERVICE_BACKED_SSO = True
-
-    user, social = authenticator_user
-
-    response = {
-        "sub": "123123123123123",
-        "preferred_username": "my_uid",
-    }
-    resp = redirect_to_resource_server(user=user, social=social, response=response)
-
-    auth_code = resp.url.split("?auth_code=")[1]
-
-    data = _validate_auth_code(auth_code, user)
-
-    assert data["sso_uid"] == "my_uid"
-    assert data["sso_backend"] == social.provider.slug
-    assert data["sso_server"] == "https://github.com/login/oauth/authorize"
-    assert data["oidc_alt_key"] == "123123123123123"
-
-
-@pytest.mark.django_db
-def test_auth_code_pipeline_no_social(user, settings):
-    settings.ENABLE_SERVICE_BACKED_SSO = True
-
+@override_settings(ENABLE_SERVICE_BACKED_SSO=True)
+def test_auth_code_pipeline_no_social(user, resource_server_config):
     resp = redirect_to_resource_server(user=user)
 
-    auth_code = resp.url.split("?auth_code=")[1]
+    auth_code = _AUTH_CODE_RE.search(resp.url).group(1)
 
-    data = _validate_auth_code(auth_code, user)
+    data = _validate_auth_code(auth_code, user, resource_server_config)
 
     assert data["sso_uid"] is None
     assert data["sso_backend"] is None
     assert data["sso_server"] is None
 
 
-@pytest.mark.django_db
-def test_auth_code_pipeline_not_authed(settings):
-    settings.ENABLE_SERVICE_BACKED_SSO = True
-
+@override_settings(ENABLE_SERVICE_BACKED_SSO=True)
+def test_auth_code_pipeline_not_authed():
     assert redirect_to_resource_server(user=None, social=None) is None
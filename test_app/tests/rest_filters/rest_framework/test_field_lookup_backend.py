@@ -1,10 +1,9 @@
-from unittest.mock import MagicMock, Mock
+from types import SimpleNamespace
 
 import pytest
 from django.conf import settings
 from django.core.exceptions import FieldDoesNotExist, FieldError, ValidationError
 from django.test.utils import override_settings
-from django.utils.http import urlencode
 from rest_framework.exceptions import ParseError, PermissionDenied
 
 from ansible_base.authentication.models import Authenticator, AuthenticatorMap
@@ -14,71 +13,75 @@ from ansible_base.rest_filters.rest_framework.field_lookup_backend import FieldL
 from test_app import models
 
 
-def test_filters_related():
-    field_lookup = FieldLookupBackend()
+@pytest.fixture(scope="module")
+def field_lookup():
+    return FieldLookupBackend()
+
+
+@pytest.fixture(scope="module")
+def remove_users_field():
+    return Authenticator._meta.get_field('remove_users')
+
+
+@pytest.fixture(scope="module")
+def authenticator_fk_field():
+    return AuthenticatorMap._meta.get_field('authenticator')
+
+
+def test_filters_related(field_lookup):
     lookup = '__'.join(['created_by', 'pk'])
     field, new_lookup = field_lookup.get_field_from_lookup(Authenticator, lookup)
 
 
-def test_filters_no_lookup():
-    field_lookup = FieldLookupBackend()
+def test_filters_no_lookup(field_lookup):
     with pytest.raises(ParseError):
         _, _ = field_lookup.get_field_from_lookup(Authenticator, '')
 
 
-def test_invalid_filter_key():
-    field_lookup = FieldLookupBackend()
+def test_invalid_filter_key(field_lookup):
     # FieldDoesNotExist is caught and converted to ParseError by filter_queryset
-    with pytest.raises(FieldDoesNotExist) as excinfo:
+    with pytest.raises(FieldDoesNotExist, match='has no field named'):
         field_lookup.value_to_python(Authenticator, 'created_by.gibberish', 'foo')
-    assert 'has no field named' in str(excinfo)
 
 
-@pytest.mark.parametrize(u"empty_value", [u'', ''])
-def test_empty_in(empty_value):
-    field_lookup = FieldLookupBackend()
-    with pytest.raises(ValueError) as excinfo:
+@pytest.mark.parametrize("empty_value", [''])
+def test_empty_in(empty_value, field_lookup):
+    with pytest.raises(ValueError, match='empty value for __in'):
         field_lookup.value_to_python(Authenticator, 'created_by__username__in', empty_value)
-    assert 'empty value for __in' in str(excinfo.value)
 
 
-@pytest.mark.parametrize(u"valid_value", [u'foo', u'foo,'])
-def test_valid_in(valid_value):
-    field_lookup = FieldLookupBackend()
+@pytest.mark.parametrize("valid_value", ['foo', 'foo,'])
+def test_valid_in(valid_value, field_lookup):
     value, new_lookup, _ = field_lookup.value_to_python(Authenticator, 'created_by__username__in', valid_value)
     assert 'foo' in value
 
 
-def test_invalid_field():
-    invalid_field = u"ヽヾ"
-    field_lookup = FieldLookupBackend()
-    with pytest.raises(ValueError) as excinfo:
+def test_invalid_field(field_lookup):
+    invalid_field = "ヽヾ"
+    with pytest.raises(ValueError, match=r'is not an allowed field name\. Must be ascii encodable\.'):
         field_lookup.value_to_python(Authenticator, invalid_field, 'foo')
-    assert 'is not an allowed field name. Must be ascii encodable.' in str(excinfo.value)
 
 
-def test_valid_iexact():
-    field_lookup = FieldLookupBackend()
+def test_valid_iexact(field_lookup):
     value, new_lookup, _ = field_lookup.value_to_python(Authenticator, 'created_by__username__iexact', 'foo')
     assert 'foo' in value
 
 
-def test_invalid_iexact():
-    field_lookup = FieldLookupBackend()
-    with pytest.raises(ValueError) as excinfo:
+def test_invalid_iexact(field_lookup):
+    with pytest.raises(ValueError, match='is not a text field and cannot be filtered by case-insensitive search'):
         field_lookup.value_to_python(Authenticator, 'id__iexact', '1')
-    assert 'is not a text field and cannot be filtered by case-insensitive search' in str(excinfo.value)
 
 
-@pytest.mark.parametrize('lookup_suffix', ['', 'contains', 'startswith', 'in'])
-def test_filter_on_password_field(lookup_suffix):
-    # Make the type field of Authenticator a PASSWORD_FIELD
-    setattr(Authenticator, 'PASSWORD_FIELDS', ('type'))
-    field_lookup = FieldLookupBackend()
-    lookup = '__'.join(filter(None, ['type', lookup_suffix]))
-    with pytest.raises(PermissionDenied) as excinfo:
+@pytest.fixture
+def password_field_type(monkeypatch):
+    # Make the type field of Authenticator a PASSWORD_FIELD, restored after the test
+    monkeypatch.setattr(Authenticator, 'PASSWORD_FIELDS', ('type',), raising=False)
+
+
+@pytest.mark.parametrize('lookup', ['type', 'type__contains', 'type__startswith', 'type__in'])
+def test_filter_on_password_field(lookup, field_lookup, password_field_type):
+    with pytest.raises(PermissionDenied, match='not allowed'):
         field, new_lookup = field_lookup.get_field_from_lookup(Authenticator, lookup)
-    assert 'not allowed' in str(excinfo.value)
 
 
 @pytest.mark.parametrize(
@@ -87,11 +90,9 @@ def test_filter_on_password_field(lookup_suffix):
         (Authenticator, 'configuration__icontains'),
     ],
 )
-def test_filter_sensitive_fields_and_relations(model, query):
-    field_lookup = FieldLookupBackend()
-    with pytest.raises(PermissionDenied) as excinfo:
+def test_filter_sensitive_fields_and_relations(model, query, field_lookup):
+    with pytest.raises(PermissionDenied, match='not allowed'):
         field, new_lookup = field_lookup.get_field_from_lookup(model, query)
-    assert 'not allowed' in str(excinfo.value)
 
 
 @pytest.mark.parametrize(
@@ -104,36 +105,33 @@ def test_filter_sensitive_fields_and_relations(model, query):
         (-1, -1),
     ),
 )
-def test_to_python_related(value, result):
-    field_lookup = FieldLookupBackend()
+def test_to_python_related(value, result, field_lookup):
     assert field_lookup.to_python_related(value) == result
 
 
-def test_to_python_related_exception():
-    field_lookup = FieldLookupBackend()
+def test_to_python_related_exception(field_lookup):
     with pytest.raises(ValueError):
         field_lookup.to_python_related('random')
 
 
-def test_value_to_python_for_field_boolean_field():
-    field_lookup = FieldLookupBackend()
-    assert field_lookup.value_to_python_for_field(Authenticator._meta.get_field('remove_users'), True) is True
+def test_value_to_python_for_field_boolean_field(field_lookup, remove_users_field):
+    assert field_lookup.value_to_python_for_field(remove_users_field, True) is True
 
 
-def test_value_to_python_for_field_fk_field_exception():
-    field_lookup = FieldLookupBackend()
+def test_value_to_python_for_field_fk_field_exception(field_lookup, authenticator_fk_field):
     with pytest.raises(ParseError):
-        field_lookup.value_to_python_for_field(AuthenticatorMap._meta.get_field('authenticator'), True)
+        field_lookup.value_to_python_for_field(authenticator_fk_field, True)
 
 
 @pytest.mark.parametrize("exception", ((ValidationError("")), (FieldError(""))))
-def test_filter_queryset_exception(exception):
-    filter = FieldLookupBackend()
-    request = MagicMock()
-    request.query_params.lists = Mock(side_effect=exception)
+def test_filter_queryset_exception(exception, field_lookup):
+    def _raise():
+        raise exception
+
+    request = SimpleNamespace(query_params=SimpleNamespace(lists=_raise))
 
     with pytest.raises(ParseError):
-        filter.filter_queryset(request, Authenticator.objects.all(), AuthenticatorViewSet)
+        field_lookup.filter_queryset(request, Authenticator.objects.none(), AuthenticatorViewSet)
 
 
 @pytest.mark.parametrize(
@@ -149,30 +147,30 @@ def test_filter_queryset_exception(exception):
         ((('authenticator__search', ['find_me,also_me']),)),
     ),
 )
-def test_filter_queryset(query):
-    filter = FieldLookupBackend()
-    request = MagicMock()
-    iterator = MagicMock()
-    iterator.__iter__.return_value = query
-    request.query_params.lists.return_value = iterator
+def test_filter_queryset(query, field_lookup):
+    request = SimpleNamespace(query_params=SimpleNamespace(lists=lambda: iter(query)))
+
+    field_lookup.filter_queryset(request, AuthenticatorMap.objects.none(), AuthenticatorViewSet)
+
 
-    filter.filter_queryset(request, AuthenticatorMap.objects.all(), AuthenticatorViewSet)
+@pytest.fixture
+def city(db):
+    return models.City.objects.create(name='city', extra_data={'mayor': 'John Doe', 'radius': 10, 'elevation': 1000, 'is_capital': True})
 
 
-def test_filter_jsonfield_as_text(admin_api_client):
-    models.City.objects.create(name='city', extra_data={'mayor': 'John Doe', 'radius': 10, 'elevation': 1000, 'is_capital': True})
+def test_filter_jsonfield_as_text(admin_api_client, city):
     url = get_relative_url('city-list')
 
     # negative test, backwards compatibility doesn't allow this case
     # JSONField isn't treated as structured data, but as a text blob
     query_params = {'extra_data__mayor__icontains': 'John Doe'}
-    response = admin_api_client.get(url + '?' + urlencode(query_params))
+    response = admin_api_client.get(url, query_params)
     assert response.status_code == 400
     assert 'No related model for field mayor' in str(response.data['detail'])
 
     # positive test, treating JSONField as a text blob
     query_params = {'extra_data__icontains': '"mayor": "John Doe"'}
-    response = admin_api_client.get(url + '?' + urlencode(query_params))
+    response = admin_api_client.get(url, query_params)
     assert response.status_code == 200
     assert response.data['count'] == 1
 